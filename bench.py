@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bot
+from fake_api import FakeBotAPI
+from telegram import Update
+from telegram.ext import CallbackContext
+FLOWS = {
+    "hold": ["✊ Держусь"],
+    "heavy": ["😔 Тяжело", "😅 Чуть не сорвался"],
+    "tips": ["😔 Тяжело", "💪 Помочь себе", "🔄 Ещё способ", "↩️ Назад"],
+    "days": ["📊 Дни"],
+}
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+def summarize(values):
+    return {"n": len(values), "p50_ms": round(percentile(values, 0.5) * 1000, 2), "p99_ms": round(percentile(values, 0.99) * 1000, 2)}
+def seed(users, history):
+    data = bot.load_data()
+    now = int(bot.NOW().timestamp())
+    for chat_id in range(1, users + 1):
+        user = bot.new_user()
+        user.active = True
+        user.pinned_message_id = chat_id
+        for msg_id in range(history):
+            user.history.append(msg_id, now)
+        data[str(chat_id)] = user
+    bot._storage.save(data)
+    bot.rebuild_index()
+class Phase:
+    def __init__(self, api):
+        self.api = api
+        self.calls = Counter(api.calls)
+        self.bytes = bot._storage.bytes_written
+        self.started = time.perf_counter()
+    def result(self, **extra):
+        calls = self.api.calls - self.calls
+        return {
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "api_calls": dict(calls),
+            "bytes_written": bot._storage.bytes_written - self.bytes,
+            **extra,
+        }
+async def drive(app, api, sample, concurrency):
+    latencies = {f"{flow}:{text}": [] for flow, texts in FLOWS.items() for text in texts}
+    errors = Counter()
+    gate = asyncio.Semaphore(concurrency)
+    async def user(chat_id, flow):
+        async with gate:
+            for text in FLOWS[flow]:
+                update = Update.de_json(api.user_update(chat_id, text), app.bot)
+                context = CallbackContext.from_update(update, app)
+                started = time.perf_counter()
+                try:
+                    await bot.handle_message(update, context)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                latencies[f"{flow}:{text}"].append(time.perf_counter() - started)
+    flows = list(FLOWS)
+    await asyncio.gather(*(user(chat_id, flows[chat_id % len(flows)]) for chat_id in range(1, sample + 1)))
+    return {name: summarize(values) for name, values in latencies.items()}, dict(errors)
+async def run_size(users, args):
+    api = FakeBotAPI(args.latency, args.jitter, args.flood)
+    port = await api.start()
+    bot.BOT_API_URL = f"http://127.0.0.1:{port}/bot"
+    bot._data = bot._storage = bot._dispatcher = bot._holds = None
+    report = {"users": users}
+    started = time.perf_counter()
+    app = bot.build_app(polling=False)
+    seed(users, args.history)
+    report["seed_seconds"] = round(time.perf_counter() - started, 3)
+    async with app:
+        context = CallbackContext(app)
+        phase = Phase(api)
+        report["handlers"], errors = await drive(app, api, min(users, args.sample), args.concurrency)
+        report["handlers_phase"] = phase.result(errors=errors)
+        phase = Phase(api)
+        holds = bot._holds
+        if holds and holds.task:
+            holds.task.cancel()
+            await asyncio.gather(*(job.done for job in await holds.flush()))
+        report["broadcast"] = phase.result()
+        phase = Phase(api)
+        await bot.morning_job(context)
+        report["morning_job"] = phase.result()
+        phase = Phase(api)
+        stats = await bot.midnight_clean(context)
+        report["midnight_clean"] = phase.result(**stats)
+        report["floods"] = dict(api.floods)
+        await bot.post_shutdown(app)
+    await api.close()
+    bot._storage.db.close()
+    return report
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота на заглушке Bot API")
+    parser.add_argument("--users", default="1000,10000,100000", help="размеры базы через запятую")
+    parser.add_argument("--sample", type=int, default=2000, help="сколько пользователей жмут кнопки")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--history", type=int, default=20, help="сообщений на пользователя для ночной очистки")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--flood", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--rate", type=float, default=1000.0, help="API_RATE, сообщений в секунду")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать JSON")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s — %(levelname)s — %(message)s', level=logging.WARNING)
+    for name in ("httpx", "apscheduler", "telegram"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    bot.logger.setLevel(logging.WARNING)
+    bot.API_RATE = args.rate
+    random.seed(args.seed)
+    results = {"revision": revision(), "args": vars(args), "runs": []}
+    cwd = os.getcwd()
+    for users in [int(n) for n in args.users.split(",")]:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            try:
+                report = asyncio.run(run_size(users, args))
+            finally:
+                os.chdir(cwd)
+        results["runs"].append(report)
+        print(json.dumps(report, ensure_ascii=False), flush=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+if __name__ == "__main__":
+    main()
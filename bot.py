@@ -2,19 +2,69 @@ import logging
 import random
 import json
 import os
+import re
+import glob
 import asyncio
-from datetime import datetime, time
+import sqlite3
+import secrets
+import signal
+import socket
+import multiprocessing
+from collections import Counter, deque
+from itertools import zip_longest
+from functools import partial
+from bisect import bisect_left
+from time import perf_counter
+from array import array
+from datetime import date, datetime, time
 from filelock import FileLock
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 import pytz
+from httpd import serve
 logging.basicConfig(format='%(asctime)s — %(levelname)s — %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise ValueError("BOT_TOKEN не установлен!")
 DATA_FILE = "user_data.json"
-LOCK_FILE = DATA_FILE + ".lock"
+DB_FILE = os.getenv("DB_FILE", "user_data.db")
+STORAGE = os.getenv("STORAGE", "sqlite")
+CLEAN_WORKERS = int(os.getenv("CLEAN_WORKERS", "8"))
+API_RATE = float(os.getenv("API_RATE", "25"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "32"))
+QUEUE_LIMIT = int(os.getenv("QUEUE_LIMIT", "5000"))
+CHAT_INTERVAL = 1.0
+INTERACTIVE, PIN, REMINDER, BROADCAST, CLEANUP = range(5)
+PRIORITIES = ("interactive", "pin", "reminder", "broadcast", "cleanup")
+PACED = (REMINDER, BROADCAST)
+HOLD_WINDOW = float(os.getenv("HOLD_WINDOW", "10"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "1.5"))
+MAX_PENDING = int(os.getenv("MAX_PENDING", "3"))
+REPEATABLE = {"📊 Дни", "✊ Держусь", "🔄 Ещё способ", "👋 Ты тут?", "❤️ Спасибо", "▶ Начать", "⏸ Пауза", "/start"}
+SWITCHES = {"▶ Начать", "⏸ Пауза", "/start"}
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+MODE = os.getenv("MODE", "polling")
+SHARDS = int(os.getenv("SHARDS", "1"))
+PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "webhook").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(24)
+LINK_QUEUE = int(os.getenv("LINK_QUEUE", "10000"))
+LINK_LIMIT = 1 << 22
+METRICS = os.getenv("METRICS", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "60"))
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+DELETE_LIMIT = 100
+CLEAN_CHUNK = 500
+DELETE_MAX_AGE = 48 * 3600
+MESSAGE_HISTORY = 500
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 NOW = lambda: datetime.now(MOSCOW_TZ)
 MORNING_MESSAGES = [
@@ -102,154 +152,785 @@ HELP_TECHNIQUES = [
 TU_TUT_FIRST = ["Тут.", "Привет.", "А куда я денусь?", "Здесь.", "Тут, как всегда.", "Да, да, привет.", "Че как?", "Ага.", "Здраствуй.", "Тут. Не переживай."]
 TU_TUT_SECOND = ["Держимся.", "Я с тобой.", "Всё по плану?", "Не хочу сегодня.", "Сегодня не буду.", "Я рядом.", "Держись.", "Все будет нормально.", "Я в деле.", "Всё под контролем."]
 HOLD_RESPONSES = ["Отправлено. ✊", "Молодец. ✊", "Красава. ✊", "Респект. ✊", "Так держать. ✊"]
-def get_main_keyboard():
-    return ReplyKeyboardMarkup([
-        [KeyboardButton("✊ Держусь"), KeyboardButton("😔 Тяжело")],
-        [KeyboardButton("📊 Дни"), KeyboardButton("👋 Ты тут?")],
-        [KeyboardButton("❤️ Спасибо"), KeyboardButton("⏸ Пауза")]
-    ], resize_keyboard=True)
-def get_start_keyboard():
-    return ReplyKeyboardMarkup([[KeyboardButton("▶ Начать")]], resize_keyboard=True)
-def get_heavy_keyboard():
-    return ReplyKeyboardMarkup([
-        [KeyboardButton("💪 Помочь себе"), KeyboardButton("😅 Чуть не сорвался")],
-        [KeyboardButton("😞 Срыв"), KeyboardButton("↩️ Назад")]
-    ], resize_keyboard=True)
-def get_help_keyboard():
-    return ReplyKeyboardMarkup([
-        [KeyboardButton("🔄 Ещё способ")],
-        [KeyboardButton("↩️ Назад")]
-    ], resize_keyboard=True)
-def load_data():
-    with FileLock(LOCK_FILE):
-        if os.path.exists(DATA_FILE):
+class Timer:
+    __slots__ = ("metrics", "name", "labels", "started")
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, perf_counter() - self.started, self.labels)
+class Metrics:
+    enabled = True
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+    def inc(self, name, labels=(), value=1):
+        self.counters[name, labels] += value
+    def observe(self, name, value, labels=(), buckets=TIME_BUCKETS):
+        hist = self.histograms.get((name, labels))
+        if hist is None:
+            hist = self.histograms[name, labels] = [buckets, [0] * (len(buckets) + 1), 0.0]
+        hist[1][bisect_left(buckets, value)] += 1
+        hist[2] += value
+    def timer(self, name, labels=()):
+        return Timer(self, name, labels)
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total) in sorted(self.histograms.items()):
+            seen = 0
+            for bound, count in zip(buckets + ("+Inf",), counts):
+                seen += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {seen}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {seen}")
+        return "\n".join(lines) + "\n"
+    def snapshot(self):
+        counters = {f"{name}{format_labels(labels)}": value for (name, labels), value in self.counters.items()}
+        histograms = {f"{name}{format_labels(labels)}": {"count": sum(counts), "sum": round(total, 4)} for (name, labels), (_, counts, total) in self.histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+class NullTimer:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
+class NullMetrics:
+    enabled = False
+    timer_ = NullTimer()
+    def inc(self, name, labels=(), value=1):
+        pass
+    def observe(self, name, value, labels=(), buckets=TIME_BUCKETS):
+        pass
+    def timer(self, name, labels=()):
+        return self.timer_
+def format_labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+metrics = Metrics() if METRICS else NullMetrics()
+class MeteredRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        started = perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("api_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            metrics.observe("api_call_seconds", perf_counter() - started, labels)
+        metrics.inc("api_calls_total", labels + (("code", code),))
+        if code == 429:
+            metrics.inc("api_retry_after_total", labels)
+        return code, payload
+async def metrics_endpoint(method, target, headers, body):
+    if target.split("?", 1)[0] != "/metrics":
+        return 404, b""
+    return 200, metrics.render().encode(), "text/plain; version=0.0.4"
+async def dump_metrics(context):
+    logger.info("metrics " + json.dumps(metrics.snapshot(), ensure_ascii=False))
+async def log_metrics():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        await dump_metrics(None)
+def retry_seconds(error):
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else delay
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.stamp = asyncio.get_running_loop().time()
+        self.blocked_until = 0
+        self.lock = asyncio.Lock()
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, asyncio.get_running_loop().time() + seconds)
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+class Dispatcher:
+    def __init__(self):
+        self.queues = [deque() for _ in PRIORITIES]
+        self.space = [None if priority <= PIN else asyncio.Semaphore(QUEUE_LIMIT) for priority in range(len(PRIORITIES))]
+        self.ready = asyncio.Semaphore(0)
+        self.limiter = RateLimiter(API_RATE)
+        self.chat_next = {}
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(DISPATCH_WORKERS)]
+    async def submit(self, priority, chat_id, call):
+        loop = asyncio.get_running_loop()
+        space = self.space[priority]
+        if space:
+            await space.acquire()
+        future = loop.create_future()
+        if space:
+            future.add_done_callback(lambda _: space.release())
+        self.push(priority, (chat_id, call, future, 0, loop.time()))
+        return future
+    async def call(self, priority, chat_id, call):
+        return await (await self.submit(priority, chat_id, call))
+    def push(self, priority, item):
+        self.queues[priority].append(item)
+        self.ready.release()
+    def take(self):
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                return priority, queue.popleft()
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.acquire()
+            await self.limiter.acquire()
+            priority, item = self.take()
+            chat_id, call, future, attempt, submitted = item
+            if future.done():
+                self.limiter.refund()
+                continue
+            now = loop.time()
+            if priority in PACED and self.chat_next.get(chat_id, 0) > now:
+                self.limiter.refund()
+                loop.call_later(self.chat_next[chat_id] - now, self.push, priority, item)
+                continue
+            if len(self.chat_next) > 10000:
+                self.chat_next = {key: value for key, value in self.chat_next.items() if value > now}
+            self.chat_next[chat_id] = now + CHAT_INTERVAL
+            metrics.observe("dispatch_wait_seconds", now - submitted, (("priority", PRIORITIES[priority]),))
             try:
-                with open(DATA_FILE, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-def save_data(data):
-    with FileLock(LOCK_FILE):
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-def get_user(user_id):
-    data = load_data()
-    uid = str(user_id)
-    if uid not in data:
-        data[uid] = {
-            "start_date": NOW().isoformat(),
-            "active": False,
-            "state": "normal",
-            "best_streak": 0,
-            "message_ids": [],
-            "hold_count": 0,
-            "hold_date": None,
-            "hold_time": None,
-            "pinned_message_id": None,
-            "used_tips": []
+                result = await call()
+            except RetryAfter as e:
+                self.limiter.pause(retry_seconds(e))
+                if attempt < 2:
+                    self.push(priority, (chat_id, call, future, attempt + 1, submitted))
+                elif not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+    async def close(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+_dispatcher = None
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = Dispatcher()
+    return _dispatcher
+async def api(priority, chat_id, call, /, *args, **kwargs):
+    return await get_dispatcher().call(priority, chat_id, partial(call, *args, **kwargs))
+class Broadcast:
+    def __init__(self, text, total):
+        loop = asyncio.get_running_loop()
+        self.text = text
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.started = loop.time()
+        self.done = loop.create_future()
+        if not total:
+            self.done.set_result(self)
+    def finish(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+        done = self.sent + self.failed
+        if done == self.total:
+            elapsed = asyncio.get_running_loop().time() - self.started
+            metrics.observe("broadcast_seconds", elapsed)
+            metrics.inc("broadcast_messages_total", (("result", "sent"),), self.sent)
+            metrics.inc("broadcast_messages_total", (("result", "failed"),), self.failed)
+            logger.info(f"Рассылка «{self.text}»: {self.sent}/{self.total}, ошибок {self.failed}, {elapsed:.1f} с")
+            self.done.set_result(self)
+        elif done % 1000 == 0:
+            logger.info(f"Рассылка «{self.text}»: {done}/{self.total}")
+async def broadcast(bot, text, chat_ids):
+    job = Broadcast(text, len(chat_ids))
+    dispatcher = get_dispatcher()
+    for chat_id in chat_ids:
+        future = await dispatcher.submit(BROADCAST, chat_id, partial(bot.send_message, chat_id, text))
+        future.add_done_callback(job.finish)
+    return job
+class HoldDigest:
+    def __init__(self, bot):
+        self.bot = bot
+        self.holders = Counter()
+        self.task = None
+    def add(self, chat_id):
+        self.holders[chat_id] += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self.flush_later())
+    async def flush_later(self):
+        await asyncio.sleep(HOLD_WINDOW)
+        await self.flush()
+    async def flush(self):
+        holders, self.holders, self.task = self.holders, Counter(), None
+        total = sum(holders.values())
+        groups = {}
+        for uid in get_active_users():
+            count = total - holders[uid]
+            if count:
+                groups.setdefault(count, []).append(uid)
+        return [await broadcast(self.bot, "✊" if count == 1 else f"✊ ×{count}", chat_ids) for count, chat_ids in groups.items()]
+    async def close(self, timeout):
+        if self.task is None:
+            return
+        self.task.cancel()
+        async def deliver():
+            await asyncio.gather(*(job.done for job in await self.flush()))
+        try:
+            await asyncio.wait_for(deliver(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Дайджест ✊ не успел уйти за {timeout:.0f} с")
+_holds = None
+_peer = None
+def get_holds(bot):
+    global _holds
+    if _holds is None:
+        _holds = HoldDigest(bot)
+    return _holds
+def publish_hold(bot, chat_id):
+    get_holds(bot).add(chat_id)
+    if _peer and not _peer.send("hold", chat_id):
+        logger.warning(f"Очередь к роутеру переполнена, ✊ от {chat_id} не передан")
+def droppable(text):
+    return text is not None and (text in REPEATABLE or text not in BUTTONS)
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.chats = {}
+        self.consumers = set()
+        self.recent = {}
+        self.suppressed = Counter()
+    def duplicate(self, chat_id, text):
+        now = asyncio.get_running_loop().time()
+        last = self.recent.get(chat_id)
+        if last and last[0] == text and now - last[1] < DEBOUNCE_WINDOW:
+            return True
+        if len(self.recent) > 10000:
+            self.recent = {key: value for key, value in self.recent.items() if now - value[1] < DEBOUNCE_WINDOW}
+        self.recent[chat_id] = (text, now)
+        return False
+    def drop(self, reason, coroutine):
+        coroutine.close()
+        self.suppressed[reason] += 1
+        metrics.inc("updates_suppressed_total", (("reason", reason),))
+    def evict(self, queue, text):
+        victim = next((item for item in queue if droppable(item[0]) and item[0] not in SWITCHES), None)
+        if victim is None and text in SWITCHES:
+            victim = next((item for item in queue if item[0] in SWITCHES), None)
+        if victim is None:
+            return False
+        queue.remove(victim)
+        self.drop("flood", victim[1])
+        return True
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        message = getattr(update, "message", None)
+        text = message.text.strip() if message and message.text else None
+        if text and text.startswith("/"):
+            text = text.split()[0].split("@")[0]
+        if text and self.duplicate(chat.id, text) and droppable(text):
+            self.drop("duplicate", coroutine)
+            return
+        queue = self.chats.get(chat.id)
+        if queue is None:
+            queue = self.chats[chat.id] = deque()
+            task = asyncio.create_task(self.consume(chat.id, queue))
+            self.consumers.add(task)
+            task.add_done_callback(self.consumers.discard)
+        elif len(queue) >= MAX_PENDING and not self.evict(queue, text):
+            self.drop("flood", coroutine)
+            return
+        queue.append((text, coroutine))
+    async def consume(self, chat_id, queue):
+        try:
+            while queue:
+                text, coroutine = queue.popleft()
+                try:
+                    async with self.running:
+                        await coroutine
+                except Exception as e:
+                    logger.error(f"Ошибка обработки апдейта для {chat_id}: {e}", exc_info=e)
+        finally:
+            del self.chats[chat_id]
+            for text, coroutine in queue:
+                coroutine.close()
+    async def join(self):
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+    async def initialize(self):
+        pass
+    async def shutdown(self):
+        for task in self.consumers:
+            task.cancel()
+        await self.join()
+        if self.suppressed:
+            logger.info(f"Отброшено апдейтов: {dict(self.suppressed)}")
+MAIN_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("✊ Держусь"), KeyboardButton("😔 Тяжело")],
+    [KeyboardButton("📊 Дни"), KeyboardButton("👋 Ты тут?")],
+    [KeyboardButton("❤️ Спасибо"), KeyboardButton("⏸ Пауза")]
+], resize_keyboard=True)
+START_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("▶ Начать")]], resize_keyboard=True)
+HEAVY_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("💪 Помочь себе"), KeyboardButton("😅 Чуть не сорвался")],
+    [KeyboardButton("😞 Срыв"), KeyboardButton("↩️ Назад")]
+], resize_keyboard=True)
+HELP_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("🔄 Ещё способ")],
+    [KeyboardButton("↩️ Назад")]
+], resize_keyboard=True)
+KEYBOARDS = (MAIN_KEYBOARD, START_KEYBOARD, HEAVY_KEYBOARD, HELP_KEYBOARD)
+KEYBOARD_PAYLOADS = {kb: json.dumps(kb.to_dict()) for kb in KEYBOARDS}
+BUTTONS = {button.text for kb in KEYBOARDS for row in kb.keyboard for button in row}
+def now_ts():
+    return int(NOW().timestamp())
+def parse_ts(value):
+    return int(datetime.fromisoformat(value).timestamp()) if value else None
+def format_ts(ts):
+    return datetime.fromtimestamp(ts, MOSCOW_TZ).isoformat() if ts is not None else None
+class MessageRing:
+    __slots__ = ("ids", "times", "head")
+    def __init__(self):
+        self.ids = array("q")
+        self.times = array("q")
+        self.head = 0
+    def __len__(self):
+        return len(self.ids)
+    def append(self, msg_id, ts):
+        if len(self.ids) < MESSAGE_HISTORY:
+            self.ids.append(msg_id)
+            self.times.append(ts)
+        else:
+            self.ids[self.head] = msg_id
+            self.times[self.head] = ts
+            self.head = (self.head + 1) % MESSAGE_HISTORY
+    def items(self):
+        head = self.head
+        return self.ids[head:] + self.ids[:head], self.times[head:] + self.times[:head]
+    def drain(self):
+        ids, times = self.items()
+        self.__init__()
+        return ids, times
+    @classmethod
+    def from_lists(cls, ids, times):
+        ring = cls()
+        untimed = len(ids) - len(times)
+        for i, msg_id in enumerate(ids):
+            ring.append(msg_id, times[i - untimed] if i >= untimed else 0)
+        return ring
+    def to_lists(self):
+        ids, times = self.items()
+        untimed = 0
+        while untimed < len(times) and not times[untimed]:
+            untimed += 1
+        return ids.tolist(), times[untimed:].tolist()
+class User:
+    __slots__ = ("start", "active", "state", "best_streak", "history", "hold_count", "hold_date", "hold_time", "pinned_message_id", "pinned_text", "used_tips", "extra")
+    def __init__(self, start=None):
+        self.start = start
+        self.active = False
+        self.state = "normal"
+        self.best_streak = 0
+        self.history = MessageRing()
+        self.hold_count = 0
+        self.hold_date = None
+        self.hold_time = None
+        self.pinned_message_id = None
+        self.pinned_text = None
+        self.used_tips = 0
+        self.extra = None
+    @classmethod
+    def from_json(cls, raw):
+        raw = dict(raw)
+        user = cls(parse_ts(raw.pop("start_date", None)))
+        user.active = bool(raw.pop("active", False))
+        user.state = raw.pop("state", "normal")
+        user.best_streak = raw.pop("best_streak", 0)
+        user.history = MessageRing.from_lists(raw.pop("message_ids", None) or [], raw.pop("message_times", None) or [])
+        user.hold_count = raw.pop("hold_count", 0)
+        hold_date = raw.pop("hold_date", None)
+        user.hold_date = date.fromisoformat(hold_date).toordinal() if hold_date else None
+        user.hold_time = parse_ts(raw.pop("hold_time", None))
+        user.pinned_message_id = raw.pop("pinned_message_id", None)
+        user.pinned_text = raw.pop("pinned_text", None)
+        user.used_tips = 0
+        for tip in raw.pop("used_tips", None) or []:
+            user.used_tips |= 1 << tip
+        user.extra = raw or None
+        return user
+    def to_json(self):
+        ids, times = self.history.to_lists()
+        raw = {
+            "start_date": format_ts(self.start),
+            "active": self.active,
+            "state": self.state,
+            "best_streak": self.best_streak,
+            "message_ids": ids,
+            "message_times": times,
+            "hold_count": self.hold_count,
+            "hold_date": date.fromordinal(self.hold_date).isoformat() if self.hold_date else None,
+            "hold_time": format_ts(self.hold_time),
+            "pinned_message_id": self.pinned_message_id,
+            "pinned_text": self.pinned_text,
+            "used_tips": [tip for tip in range(self.used_tips.bit_length()) if self.used_tips >> tip & 1]
         }
-        save_data(data)
-    return data, data[uid]
-def get_days(user_id):
-    _, user = get_user(user_id)
-    if user.get("start_date"):
-        start = datetime.fromisoformat(user["start_date"])
-        return (NOW() - start).days
+        if self.extra:
+            raw.update(self.extra)
+        return raw
+class JsonStorage:
+    def __init__(self, path):
+        self.path = path
+        self.lock = path + ".lock"
+        self.bytes_written = 0
+    def load(self, strict=False):
+        started = perf_counter()
+        with FileLock(self.lock):
+            locked = perf_counter()
+            metrics.observe("storage_lock_wait_seconds", locked - started, (("op", "load"),))
+            try:
+                if os.path.exists(self.path):
+                    try:
+                        with open(self.path, "r", encoding="utf-8") as f:
+                            raw = json.load(f)
+                            metrics.inc("storage_bytes_read_total", value=f.tell())
+                        return {uid: User.from_json(user) for uid, user in raw.items()}
+                    except:
+                        if strict:
+                            raise
+                        return {}
+                return {}
+            finally:
+                metrics.observe("storage_lock_hold_seconds", perf_counter() - locked, (("op", "load"),))
+    def save(self, data, uids=None):
+        started = perf_counter()
+        with FileLock(self.lock):
+            locked = perf_counter()
+            metrics.observe("storage_lock_wait_seconds", locked - started, (("op", "save"),))
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({uid: user.to_json() for uid, user in data.items()}, f, ensure_ascii=False, separators=(",", ":"))
+                self.bytes_written += f.tell()
+        metrics.observe("storage_lock_hold_seconds", perf_counter() - locked, (("op", "save"),))
+class SqliteStorage:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.bytes_written = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    def load(self):
+        data = {}
+        for uid, raw in self.db.execute("SELECT uid, data FROM users"):
+            data[uid] = User.from_json(json.loads(raw))
+            metrics.inc("storage_bytes_read_total", value=len(uid) + len(raw))
+        return data
+    def save(self, data, uids=None):
+        rows = [(uid, json.dumps(data[uid].to_json(), ensure_ascii=False, separators=(",", ":"))) for uid in (data if uids is None else uids)]
+        self.bytes_written += sum(len(uid) + len(raw.encode()) for uid, raw in rows)
+        with metrics.timer("storage_write_seconds"):
+            self.write("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", rows)
+    def write(self, sql, rows):
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(sql, rows)
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+def shard_of(chat_id):
+    return int(chat_id) % SHARDS
+def shard_file(shard):
+    root, ext = os.path.splitext(DB_FILE)
+    return f"{root}.{shard}{ext}" if SHARDS > 1 else DB_FILE
+def shard_files():
+    root, ext = os.path.splitext(DB_FILE)
+    pattern = re.compile(re.escape(root) + r"(\.\d+)?" + re.escape(ext))
+    return sorted(path for path in glob.glob(glob.escape(root) + "*" + ext) if pattern.fullmatch(path))
+def start_of(raw):
+    return parse_ts(json.loads(raw).get("start_date")) or float("inf")
+def reshard(storages):
+    targets = {shard_file(shard): storage for shard, storage in enumerate(storages)}
+    moved = conflicts = 0
+    for path in shard_files():
+        source = targets.get(path) or SqliteStorage(path)
+        rows = [(uid, raw) for uid, raw in source.db.execute("SELECT uid, data FROM users") if shard_file(shard_of(uid)) != path]
+        groups = {}
+        for uid, raw in rows:
+            groups.setdefault(shard_file(shard_of(uid)), []).append((uid, raw))
+        for target, batch in groups.items():
+            storage = targets[target]
+            fresh = []
+            for uid, raw in batch:
+                current = storage.db.execute("SELECT data FROM users WHERE uid = ?", (uid,)).fetchone()
+                if current and current[0] != raw:
+                    conflicts += 1
+                    if start_of(current[0]) <= start_of(raw):
+                        continue
+                fresh.append((uid, raw))
+            storage.write("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", fresh)
+        if rows:
+            source.write("DELETE FROM users WHERE uid = ?", [(uid,) for uid, _ in rows])
+            moved += len(rows)
+            logger.info(f"{path}: {len(rows)} пользователей перенесены в свои шарды")
+        if path not in targets:
+            source.db.close()
+    if conflicts:
+        logger.warning(f"Пользователей в двух шардах сразу: {conflicts}, оставлены записи с более ранним стартом")
+    return moved
+def migrate_json(storages, path=DATA_FILE):
+    if not os.path.exists(path):
+        return
+    try:
+        data = JsonStorage(path).load(strict=True)
+    except Exception as e:
+        raise ValueError(f"Не удалось прочитать {path}, перенос в SQLite остановлен: {e}") from e
+    for shard, storage in enumerate(storages):
+        storage.save({uid: user for uid, user in data.items() if shard_of(uid) == shard})
+    os.replace(path, path + ".migrated")
+    logger.info(f"Перенесено {len(data)} пользователей из {path} в SQLite ({len(storages)} шт.)")
+def open_storage():
+    if STORAGE == "json":
+        return JsonStorage(DATA_FILE)
+    storage = SqliteStorage(DB_FILE)
+    if SHARDS == 1:
+        reshard([storage])
+        migrate_json([storage])
+    return storage
+_storage = None
+_data = None
+_active = set()
+def load_data():
+    global _storage, _data
+    if _data is None:
+        _storage = open_storage()
+        _data = _storage.load()
+        rebuild_index()
+    return _data
+def rebuild_index():
+    _active.clear()
+    _active.update(int(uid) for uid, user in _data.items() if user.active)
+def index_user(chat_id, user):
+    if user.active:
+        _active.add(chat_id)
+    else:
+        _active.discard(chat_id)
+def save_data(data, uid=None):
+    load_data()
+    _storage.save(data, None if uid is None else [str(uid)])
+def new_user():
+    return User(now_ts())
+class Session:
+    __slots__ = ("chat_id", "data", "user", "dirty")
+    def __init__(self, chat_id):
+        data = load_data()
+        uid = str(chat_id)
+        object.__setattr__(self, "chat_id", chat_id)
+        object.__setattr__(self, "data", data)
+        object.__setattr__(self, "dirty", uid not in data)
+        if self.dirty:
+            data[uid] = new_user()
+            index_user(chat_id, data[uid])
+        object.__setattr__(self, "user", data[uid])
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+    def __setattr__(self, name, value):
+        if name == "dirty":
+            object.__setattr__(self, name, value)
+            return
+        setattr(self.user, name, value)
+        object.__setattr__(self, "dirty", True)
+    def touch(self):
+        self.dirty = True
+    def flush(self):
+        written = 0
+        if self.dirty:
+            before = _storage.bytes_written
+            save_data(self.data, self.chat_id)
+            written = _storage.bytes_written - before
+            self.dirty = False
+        metrics.observe("session_bytes_written", written, buckets=SIZE_BUCKETS)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.flush()
+def get_days(session):
+    if session.start:
+        return (now_ts() - session.start) // 86400
     return 0
-def reset_streak(user_id):
-    data, user = get_user(user_id)
-    current = get_days(user_id)
-    if current > user.get("best_streak", 0):
-        user["best_streak"] = current
-    user["start_date"] = NOW().isoformat()
-    user["hold_count"] = 0
-    user["hold_date"] = None
-    user["hold_time"] = None
-    save_data(data)
+def reset_streak(session):
+    current = get_days(session)
+    if current > session.best_streak:
+        session.best_streak = current
+    session.start = now_ts()
+    session.hold_count = 0
+    session.hold_date = None
+    session.hold_time = None
 def get_active_users():
-    return [int(uid) for uid, u in load_data().items() if u.get("active")]
-def get_next_tip(user_data: dict) -> str:
-    used = user_data.setdefault("used_tips", [])
-    if len(used) >= len(HELP_TECHNIQUES):
-        used.clear()
-    available = [i for i in range(len(HELP_TECHNIQUES)) if i not in used]
+    load_data()
+    return list(_active)
+def set_active(session, active):
+    session.active = active
+    index_user(session.chat_id, session.user)
+def get_next_tip(session) -> str:
+    used = session.used_tips
+    if used == (1 << len(HELP_TECHNIQUES)) - 1:
+        used = 0
+    available = [i for i in range(len(HELP_TECHNIQUES)) if not used >> i & 1]
     choice = random.choice(available)
-    used.append(choice)
+    session.used_tips = used | 1 << choice
     return HELP_TECHNIQUES[choice]
-async def update_pin(bot, chat_id):
-    days = get_days(chat_id)
-    _, user = get_user(chat_id)
-    best = user.get("best_streak", 0)
+async def update_pin(bot, session):
+    chat_id = session.chat_id
+    days = get_days(session)
+    best = session.best_streak
     text = f"Первый день • Лучший стрик: {best}" if days == 0 else f"День {days} • Лучший стрик: {best}"
-    pin_id = user.get("pinned_message_id")
+    pin_id = session.pinned_message_id
+    if pin_id and session.pinned_text == text:
+        metrics.inc("pin_edits_skipped_total")
+        return
     try:
         if pin_id:
-            await bot.edit_message_text(chat_id=chat_id, message_id=pin_id, text=text)
+            try:
+                await api(PIN, chat_id, bot.edit_message_text, chat_id=chat_id, message_id=pin_id, text=text)
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    raise
         else:
-            msg = await bot.send_message(chat_id, text)
-            await bot.pin_chat_message(chat_id, msg.message_id, disable_notification=True)
-            data, _ = get_user(chat_id)
-            data[str(chat_id)]["pinned_message_id"] = msg.message_id
-            save_data(data)
+            msg = await api(PIN, chat_id, bot.send_message, chat_id, text)
+            await api(PIN, chat_id, bot.pin_chat_message, chat_id, msg.message_id, disable_notification=True)
+            session.pinned_message_id = msg.message_id
+        session.pinned_text = text
     except Exception as e:
         logger.warning(f"Ошибка pin для {chat_id}: {e}")
-async def send(bot, chat_id, text, keyboard=None, save=True):
-    kb = keyboard or get_main_keyboard()
-    msg = await bot.send_message(chat_id, text, reply_markup=kb)
+async def send(bot, session, text, keyboard=None, save=True, priority=INTERACTIVE):
+    kb = keyboard or MAIN_KEYBOARD
+    payload = KEYBOARD_PAYLOADS.get(kb)
+    markup = {"api_kwargs": {"reply_markup": payload}} if payload else {"reply_markup": kb}
+    msg = await api(priority, session.chat_id, bot.send_message, session.chat_id, text, **markup)
     if save:
-        data, _ = get_user(chat_id)
-        data[str(chat_id)].setdefault("message_ids", []).append(msg.message_id)
-        if len(data[str(chat_id)]["message_ids"]) > 500:
-            data[str(chat_id)]["message_ids"] = data[str(chat_id)]["message_ids"][-500:]
-        save_data(data)
+        session.history.append(msg.message_id, now_ts())
+        session.touch()
     return msg
+async def send_morning(bot, chat_id):
+    with Session(chat_id) as session:
+        if not session.active:
+            return
+        text = MILESTONES.get(get_days(session), random.choice(MORNING_MESSAGES))
+        await send(bot, session, text, priority=REMINDER)
+        await update_pin(bot, session)
+async def send_evening(bot, chat_id):
+    with Session(chat_id) as session:
+        if not session.active:
+            return
+        await send(bot, session, random.choice(EVENING_MESSAGES), priority=REMINDER)
+async def send_night(bot, chat_id):
+    with Session(chat_id) as session:
+        if not session.active:
+            return
+        await send(bot, session, random.choice(NIGHT_MESSAGES), priority=REMINDER)
+        await update_pin(bot, session)
+def observe_lag(context):
+    if metrics.enabled and context.job and isinstance(context.job.data, time):
+        now = NOW()
+        planned = now.replace(hour=context.job.data.hour, minute=context.job.data.minute, second=0, microsecond=0)
+        metrics.observe("job_lag_seconds", (now - planned).total_seconds() % 86400, (("job", context.job.name),))
+async def run_cohort(context, job):
+    observe_lag(context)
+    started = perf_counter()
+    users = get_active_users()
+    pending = iter(users)
+    async def worker():
+        for uid in pending:
+            try:
+                await job(context.bot, uid)
+            except Exception as e:
+                logger.warning(f"Ошибка {job.__name__} для {uid}: {e}")
+    await asyncio.gather(*(worker() for _ in range(min(len(users), QUEUE_LIMIT))))
+    metrics.observe("job_seconds", perf_counter() - started, (("job", job.__name__),))
+    logger.info(f"{job.__name__}: {len(users)} пользователей")
 async def morning_job(context):
-    chat_id = context.job.chat_id
-    _, user = get_user(chat_id)
-    if not user.get("active"): return
-    days = get_days(chat_id)
-    text = MILESTONES.get(days, random.choice(MORNING_MESSAGES))
-    await send(context.bot, chat_id, text)
-    await update_pin(context.bot, chat_id)
+    await run_cohort(context, send_morning)
 async def evening_job(context):
-    chat_id = context.job.chat_id
-    _, user = get_user(chat_id)
-    if not user.get("active"): return
-    await send(context.bot, chat_id, random.choice(EVENING_MESSAGES))
+    await run_cohort(context, send_evening)
 async def night_job(context):
-    chat_id = context.job.chat_id
-    _, user = get_user(chat_id)
-    if not user.get("active"): return
-    await send(context.bot, chat_id, random.choice(NIGHT_MESSAGES))
-    await update_pin(context.bot, chat_id)
+    await run_cohort(context, send_night)
+def take_messages(user, now):
+    ids, times = user.history.drain()
+    fresh = [msg_id for msg_id, ts in zip(ids, times) if not ts or now - ts < DELETE_MAX_AGE]
+    return fresh, len(ids) - len(fresh)
 async def midnight_clean(context):
-    chat_id = context.job.chat_id
-    data, user = get_user(chat_id)
-    ids = user.get("message_ids", [])
-    user["message_ids"] = []
-    save_data(data)
-    for msg_id in ids:
-        try:
-            await context.bot.delete_message(chat_id, msg_id)
-            await asyncio.sleep(0.05)
-        except:
-            pass
-def schedule_jobs(chat_id, job_queue):
-    for name in [f"morning_{chat_id}", f"evening_{chat_id}", f"night_{chat_id}", f"midnight_{chat_id}"]:
-        for job in job_queue.get_jobs_by_name(name):
-            job.schedule_removal()
-    job_queue.run_daily(morning_job, time(9, 0, tzinfo=MOSCOW_TZ), chat_id=chat_id, name=f"morning_{chat_id}")
-    job_queue.run_daily(evening_job, time(18, 0, tzinfo=MOSCOW_TZ), chat_id=chat_id, name=f"evening_{chat_id}")
-    job_queue.run_daily(night_job, time(23, 0, tzinfo=MOSCOW_TZ), chat_id=chat_id, name=f"night_{chat_id}")
-    job_queue.run_daily(midnight_clean, time(0, 1, tzinfo=MOSCOW_TZ), chat_id=chat_id, name=f"midnight_{chat_id}")
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    data, user = get_user(chat_id)
-    user["active"] = True
-    user["state"] = "normal"
-    save_data(data)
-    await send(context.bot, chat_id,
+    observe_lag(context)
+    started = perf_counter()
+    now = int(NOW().timestamp())
+    stats = Counter()
+    chats = []
+    data = load_data()
+    users = get_active_users()
+    for start in range(0, len(users), CLEAN_CHUNK):
+        drained = []
+        for chat_id in users[start:start + CLEAN_CHUNK]:
+            user = data.get(str(chat_id))
+            if not user or not user.history:
+                continue
+            ids, skipped = take_messages(user, now)
+            drained.append(str(chat_id))
+            stats["skipped"] += skipped
+            chats.append([(chat_id, ids[i:i + DELETE_LIMIT]) for i in range(0, len(ids), DELETE_LIMIT)])
+        if drained:
+            _storage.save(data, drained)
+        await asyncio.sleep(0)
+    batches = iter([batch for row in zip_longest(*chats) for batch in row if batch])
+    async def worker():
+        for chat_id, ids in batches:
+            try:
+                await api(CLEANUP, chat_id, context.bot.delete_messages, chat_id, ids)
+                stats["deleted"] += len(ids)
+            except TelegramError as e:
+                logger.warning(f"Ошибка очистки для {chat_id}: {e}")
+                stats["failed"] += len(ids)
+    await asyncio.gather(*(worker() for _ in range(CLEAN_WORKERS)))
+    metrics.observe("job_seconds", perf_counter() - started, (("job", "midnight_clean"),))
+    for result, count in stats.items():
+        metrics.inc("cleanup_messages_total", (("result", result),), count)
+    logger.info(f"Очистка: удалено {stats['deleted']}, ошибок {stats['failed']}, пропущено старых {stats['skipped']}")
+    return stats
+def schedule_jobs(job_queue):
+    for callback, at, name in (
+        (morning_job, time(9, 0, tzinfo=MOSCOW_TZ), "morning"),
+        (evening_job, time(18, 0, tzinfo=MOSCOW_TZ), "evening"),
+        (night_job, time(23, 0, tzinfo=MOSCOW_TZ), "night"),
+        (midnight_clean, time(0, 1, tzinfo=MOSCOW_TZ), "midnight"),
+    ):
+        job_queue.run_daily(callback, at, name=name, data=at)
+    if METRICS == "log":
+        job_queue.run_repeating(dump_metrics, METRICS_INTERVAL, name="metrics")
+async def activate(bot, session):
+    set_active(session, True)
+    session.state = "normal"
+    await send(bot, session,
         "Привет, брат.\n\n"
         "Я буду писать три раза в день — просто напомнить: сегодня не надо.\n\n"
         "Когда тяжело — жми «✊ Держусь».\n"
@@ -257,123 +938,287 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Можешь жать до 5 раз в день, если совсем пиздец.\n\n"
         "Держись, я рядом.",
         save=False)
-    await update_pin(context.bot, chat_id)
-    schedule_jobs(chat_id, context.job_queue)
+    await update_pin(bot, session)
+async def deactivate(bot, session):
+    set_active(session, False)
+    session.state = "normal"
+    await send(bot, session, "Уведомления приостановлены. Жми ▶ Начать, когда будешь готов.", START_KEYBOARD, False)
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with metrics.timer("handler_seconds", (("handler", "start"),)), Session(update.effective_chat.id) as session:
+        await activate(context.bot, session)
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    data, user = get_user(chat_id)
-    user["active"] = False
-    user["state"] = "normal"
-    save_data(data)
-    for name in [f"morning_{chat_id}", f"evening_{chat_id}", f"night_{chat_id}", f"midnight_{chat_id}"]:
-        for job in context.job_queue.get_jobs_by_name(name):
-            job.schedule_removal()
-    await send(context.bot, chat_id, "Уведомления приостановлены. Жми ▶ Начать, когда будешь готов.", get_start_keyboard(), False)
-async def handle_hold(chat_id, context):
-    data, user = get_user(chat_id)
-    today = NOW().date()
-    last_date = user.get("hold_date")
-    last_time = user.get("hold_time")
-    count = user.get("hold_count", 0)
-    if str(last_date) != str(today):
+    with metrics.timer("handler_seconds", (("handler", "stop"),)), Session(update.effective_chat.id) as session:
+        await deactivate(context.bot, session)
+async def handle_hold(session, context):
+    now = now_ts()
+    today = NOW().date().toordinal()
+    count = session.hold_count
+    if session.hold_date != today:
         count = 0
-    if last_time:
-        if (NOW() - datetime.fromisoformat(last_time)).total_seconds() < 1800:
-            minutes_left = int((1800 - (NOW() - datetime.fromisoformat(last_time)).total_seconds()) / 60)
-            await send(context.bot, chat_id, f"Погоди ещё {minutes_left} минут, брат.")
+    if session.hold_time:
+        if now - session.hold_time < 1800:
+            minutes_left = int((1800 - (now - session.hold_time)) / 60)
+            await send(context.bot, session, f"Погоди ещё {minutes_left} минут, брат.")
             return
     if count >= 5:
-        await send(context.bot, chat_id, "Сегодня это уже 5 раз, брат, тормози. Завтра сможешь отправить еще. ✊")
+        await send(context.bot, session, "Сегодня это уже 5 раз, брат, тормози. Завтра сможешь отправить еще. ✊")
         return
-    await send(context.bot, chat_id, random.choice(HOLD_RESPONSES), save=False)
-    for uid in get_active_users():
-        if uid != chat_id:
-            try:
-                await context.bot.send_message(uid, "✊")
-                await asyncio.sleep(0.08)
-            except:
-                pass
-    user["hold_time"] = NOW().isoformat()
-    user["hold_date"] = str(today)
-    user["hold_count"] = count + 1
-    save_data(data)
+    await send(context.bot, session, random.choice(HOLD_RESPONSES), save=False)
+    publish_hold(context.bot, session.chat_id)
+    session.hold_time = now
+    session.hold_date = today
+    session.hold_count = count + 1
+async def delayed_reply(context):
+    with Session(context.job.chat_id) as session:
+        await send(context.bot, session, context.job.data)
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
-    chat_id = update.effective_chat.id
-    data, user = get_user(chat_id)
-    state = user.get("state", "normal")
+    labels = (("handler", "message"), ("button", text if text in BUTTONS else "other"))
+    with metrics.timer("handler_seconds", labels), Session(update.effective_chat.id) as session:
+        await handle_button(text, session, context)
+async def handle_button(text, session, context):
+    bot = context.bot
+    state = session.state
     if state == "heavy_menu":
         if text == "💪 Помочь себе":
-            tip = get_next_tip(user)
-            await send(context.bot, chat_id, tip, get_help_keyboard(), False)
-            user["state"] = "help_mode"
-            save_data(data)
+            tip = get_next_tip(session)
+            await send(bot, session, tip, HELP_KEYBOARD, False)
+            session.state = "help_mode"
             return
         if text == "😞 Срыв":
-            reset_streak(chat_id)
-            await send(context.bot, chat_id, "Ничего страшного.\nНачнём заново. Ты молодец, что сказал честно.", get_main_keyboard(), False)
-            await update_pin(context.bot, chat_id)
-            user["state"] = "normal"
-            save_data(data)
+            reset_streak(session)
+            await send(bot, session, "Ничего страшного.\nНачнём заново. Ты молодец, что сказал честно.", MAIN_KEYBOARD, False)
+            await update_pin(bot, session)
+            session.state = "normal"
             return
         if text == "😅 Чуть не сорвался":
-            await send(context.bot, chat_id, "Красавчик. Это и есть победа. ✊", get_main_keyboard(), False)
-            user["state"] = "normal"
-            save_data(data)
+            await send(bot, session, "Красавчик. Это и есть победа. ✊", MAIN_KEYBOARD, False)
+            session.state = "normal"
             return
         if text == "↩️ Назад":
-            user["state"] = "normal"
-            user["used_tips"] = []
-            save_data(data)
-            await send(context.bot, chat_id, "Держись.", get_main_keyboard(), False)
+            session.state = "normal"
+            session.used_tips = 0
+            await send(bot, session, "Держись.", MAIN_KEYBOARD, False)
             return
     if state == "help_mode":
         if text == "🔄 Ещё способ":
-            tip = get_next_tip(user)
-            await send(context.bot, chat_id, tip, get_help_keyboard(), False)
-            save_data(data)
+            tip = get_next_tip(session)
+            await send(bot, session, tip, HELP_KEYBOARD, False)
             return
         if text == "↩️ Назад":
-            user["state"] = "normal"
-            user["used_tips"] = []
-            save_data(data)
-            await send(context.bot, chat_id, "Держись там.", get_main_keyboard(), False)
+            session.state = "normal"
+            session.used_tips = 0
+            await send(bot, session, "Держись там.", MAIN_KEYBOARD, False)
             return
     if text == "▶ Начать":
-        await start(update, context)
+        await activate(bot, session)
     elif text == "👋 Ты тут?":
-        await asyncio.sleep(random.uniform(2.8, 5.5))
-        await send(context.bot, chat_id, random.choice(TU_TUT_FIRST))
-        await asyncio.sleep(random.uniform(2.0, 4.5))
-        await send(context.bot, chat_id, random.choice(TU_TUT_SECOND))
+        first = random.uniform(2.8, 5.5)
+        context.job_queue.run_once(delayed_reply, first, chat_id=session.chat_id, data=random.choice(TU_TUT_FIRST))
+        context.job_queue.run_once(delayed_reply, first + random.uniform(2.0, 4.5), chat_id=session.chat_id, data=random.choice(TU_TUT_SECOND))
     elif text == "✊ Держусь":
-        await handle_hold(chat_id, context)
+        await handle_hold(session, context)
     elif text == "😔 Тяжело":
-        user["state"] = "heavy_menu"
-        user["used_tips"] = []
-        save_data(data)
-        await send(context.bot, chat_id, "Что будем делать?", get_heavy_keyboard(), False)
+        session.state = "heavy_menu"
+        session.used_tips = 0
+        await send(bot, session, "Что будем делать?", HEAVY_KEYBOARD, False)
     elif text == "📊 Дни":
-        days = get_days(chat_id)
-        best = user.get("best_streak", 0)
+        days = get_days(session)
+        best = session.best_streak
         msg = "Первый день." if days == 0 else "Прошёл 1 день." if days == 1 else f"Прошло {days} дней."
         if best > 0 and best != days:
             msg += f"\n\nТвой лучший стрик: {best} дней."
-        await send(context.bot, chat_id, msg)
+        await send(bot, session, msg)
     elif text == "❤️ Спасибо":
-        await send(context.bot, chat_id,
+        await send(bot, session,
             "Спасибо, брат. ❤️\n\nЕсли хочешь поддержать:\nСбер 2202 2084 3481 5313\n\nГлавное — держись.",
             save=False)
     elif text == "⏸ Пауза":
-        await stop(update, context)
+        await deactivate(bot, session)
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc("errors_total", (("error", type(context.error).__name__),))
     logger.error(f"Ошибка: {context.error}", exc_info=context.error)
-def main():
-    app = Application.builder().token(TOKEN).build()
+_metrics_server = None
+async def post_init(app):
+    global _metrics_server
+    if METRICS == "http":
+        _metrics_server = await serve(metrics_endpoint, "0.0.0.0", METRICS_PORT)
+        logger.info(f"Метрики на порту {METRICS_PORT}")
+async def post_stop(app):
+    await app.update_processor.join()
+    if _holds:
+        await _holds.close(SHUTDOWN_TIMEOUT)
+async def post_shutdown(app):
+    global _metrics_server
+    if _dispatcher:
+        await _dispatcher.close()
+    if _metrics_server:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+def build_app(polling=True):
+    builder = (Application.builder().token(TOKEN).base_url(BOT_API_URL)
+        .concurrent_updates(ChatOrderedProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown))
+    if metrics.enabled:
+        builder = builder.request(MeteredRequest(connection_pool_size=256))
+    if not polling:
+        builder = builder.updater(None)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_error_handler(error_handler)
+    load_data()
+    schedule_jobs(app.job_queue)
+    return app
+def update_chat_id(payload):
+    for value in payload.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"]
+    return None
+class Link:
+    def __init__(self):
+        self.outbox = asyncio.Queue(LINK_QUEUE)
+    def send(self, kind, payload):
+        try:
+            self.outbox.put_nowait((kind, payload))
+        except asyncio.QueueFull:
+            return False
+        return True
+    async def pump(self, writer):
+        try:
+            while True:
+                message = await self.outbox.get()
+                writer.write(json.dumps(message).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+async def read_link(reader):
+    try:
+        line = await reader.readline()
+    except (ConnectionError, ValueError):
+        return None
+    return json.loads(line) if line.endswith(b"\n") else None
+async def serve_shard(app, sock):
+    global _peer
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=LINK_LIMIT)
+    _peer = Link()
+    pump = asyncio.create_task(_peer.pump(writer))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, reader.feed_eof)
+    async with app:
+        await post_init(app)
+        await app.start()
+        while (message := await read_link(reader)) is not None:
+            kind, payload = message
+            if kind == "update":
+                await app.update_queue.put(Update.de_json(payload, app.bot))
+            elif kind == "hold":
+                get_holds(app.bot).add(payload)
+            elif kind == "stop":
+                break
+        await app.stop()
+        await post_stop(app)
+        await post_shutdown(app)
+    pump.cancel()
+    writer.close()
+def run_shard(shard, sock):
+    global DB_FILE, API_RATE, METRICS_PORT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    DB_FILE = shard_file(shard)
+    METRICS_PORT += shard + 1
+    API_RATE /= SHARDS
+    logger.info(f"Шард {shard}/{SHARDS}: {DB_FILE}")
+    asyncio.run(serve_shard(build_app(polling=False), sock))
+class Shard:
+    def __init__(self, index):
+        self.index = index
+        self.link = Link()
+        self.process = None
+        self.stopping = False
+    async def supervise(self, relay):
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            ours, theirs = socket.socketpair()
+            self.process = multiprocessing.get_context("spawn").Process(target=run_shard, args=(self.index, theirs), name=f"shard-{self.index}")
+            self.process.start()
+            theirs.close()
+            reader, writer = await asyncio.open_unix_connection(sock=ours, limit=LINK_LIMIT)
+            pump = asyncio.create_task(self.link.pump(writer))
+            while (message := await read_link(reader)) is not None:
+                relay(self.index, message)
+            pump.cancel()
+            writer.close()
+            await loop.run_in_executor(None, self.process.join)
+            if not self.stopping:
+                logger.error(f"Шард {self.index} завершился с кодом {self.process.exitcode}, перезапуск")
+                metrics.inc("shard_restarts_total", (("shard", self.index),))
+                await asyncio.sleep(1)
+    def stop(self):
+        self.stopping = True
+        if not self.link.send("stop", None) and self.process:
+            self.process.terminate()
+async def route():
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    shards = [Shard(index) for index in range(SHARDS)]
+    def relay(index, message):
+        for shard in shards:
+            if shard.index != index and not shard.link.send(*message):
+                logger.warning(f"Шард {shard.index} не успевает, ✊ не передан")
+    async def webhook(method, target, headers, body):
+        if method != "POST" or target != WEBHOOK_PATH:
+            return 404, b""
+        if headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403, b""
+        payload = json.loads(body)
+        chat_id = update_chat_id(payload)
+        if not shards[0 if chat_id is None else shard_of(chat_id)].link.send("update", payload):
+            metrics.inc("webhook_updates_total", (("result", "rejected"),))
+            return 503, b""
+        metrics.inc("webhook_updates_total", (("result", "routed"),))
+        return 200, b""
+    server = await serve(webhook, "0.0.0.0", PORT)
+    await post_init(None)
+    dumper = asyncio.create_task(log_metrics()) if METRICS == "log" else None
+    tasks = [asyncio.create_task(shard.supervise(relay)) for shard in shards]
+    try:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+        async with Bot(TOKEN, base_url=BOT_API_URL) as bot:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Вебхук на порту {PORT}, шардов: {SHARDS}")
+        await stopped.wait()
+    finally:
+        server.close()
+        for shard in shards:
+            shard.stop()
+        await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT + 10)
+        for shard in shards:
+            if shard.process and shard.process.is_alive():
+                shard.process.kill()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if dumper:
+            dumper.cancel()
+        await post_shutdown(None)
+def run_webhook():
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL не установлен!")
+    if SHARDS > 1 and STORAGE == "json":
+        raise ValueError("Шарды работают только с STORAGE=sqlite")
+    if STORAGE != "json":
+        storages = [SqliteStorage(shard_file(shard)) for shard in range(SHARDS)]
+        reshard(storages)
+        migrate_json(storages)
+        for storage in storages:
+            storage.db.close()
+    asyncio.run(route())
+def main():
     logger.info("Кент на посту ✊")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if MODE == "webhook":
+        run_webhook()
+    else:
+        build_app().run_polling(allowed_updates=Update.ALL_TYPES)
 if __name__ == "__main__":
     main()
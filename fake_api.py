@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+from httpd import serve
+logger = logging.getLogger(__name__)
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Кент", "username": "fake_bot"}
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, flood=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood = flood
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.floods = Counter()
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.updates = []
+        self.arrived = asyncio.Event()
+        self.server = None
+    def message(self, chat_id, text, message_id=None):
+        return {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+    def user_update(self, chat_id, text):
+        chat = {"id": chat_id, "type": "private", "first_name": str(chat_id)}
+        sender = {"id": chat_id, "is_bot": False, "first_name": str(chat_id)}
+        return {
+            "update_id": next(self.update_ids),
+            "message": {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat, "from": sender, "text": text},
+        }
+    def push(self, chat_id, text):
+        update = self.user_update(chat_id, text)
+        self.updates.append(update)
+        self.arrived.set()
+        return update
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit") or 100)]
+    async def call(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if method == "sendMessage":
+            return self.message(params["chat_id"], params.get("text", ""))
+        if method == "editMessageText":
+            return self.message(params["chat_id"], params.get("text", ""), int(params["message_id"]))
+        return True
+    async def handle(self, method, target, headers, body):
+        if target.startswith("/fake/updates") and method == "POST":
+            request = json.loads(body)
+            return 200, json.dumps(self.push(request["chat_id"], request["text"])).encode()
+        if target.startswith("/fake/stats"):
+            return 200, json.dumps({"calls": self.calls, "floods": self.floods}).encode()
+        parts = target.split("?", 1)[0].strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, json.dumps({"ok": False, "error_code": 404, "description": "Not Found"}).encode()
+        params = parse_params(headers.get("content-type", ""), body)
+        if parts[1] != "getUpdates":
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+            if self.flood and random.random() < self.flood:
+                self.floods[parts[1]] += 1
+                error = {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}", "parameters": {"retry_after": self.retry_after}}
+                return 429, json.dumps(error).encode()
+        result = await self.call(parts[1], params)
+        return 200, json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode()
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await serve(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+def parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    params = {}
+    for key, value in parse_qsl(body.decode()):
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+async def run(host, port, latency, jitter, flood):
+    api = FakeBotAPI(latency, jitter, flood)
+    port = await api.start(host, port)
+    logger.info(f"Fake Bot API: BOT_API_URL=http://{host}:{port}/bot")
+    await asyncio.Event().wait()
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--flood", type=float, default=0.0, help="доля ответов 429")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s — %(levelname)s — %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(run(args.host, args.port, args.latency, args.jitter, args.flood))
+    except KeyboardInterrupt:
+        pass
+if __name__ == "__main__":
+    main()
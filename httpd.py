@@ -0,0 +1,52 @@
+import asyncio
+import logging
+logger = logging.getLogger(__name__)
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+MAX_BODY = 1 << 20
+MAX_HEADERS = 100
+TIMEOUT = 30
+async def read_request(reader, max_body=MAX_BODY):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise ValueError("too many headers")
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if not 0 <= length <= max_body:
+        return method, target, headers, None
+    body = await reader.readexactly(length)
+    return method, target, headers, body
+def render_response(status, body=b"", content_type="application/json"):
+    head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+    return head.encode("latin-1") + body
+async def serve(handler, host, port, max_body=MAX_BODY, timeout=TIMEOUT):
+    async def connection(reader, writer):
+        try:
+            while True:
+                request = await asyncio.wait_for(read_request(reader, max_body), timeout)
+                if request is None:
+                    break
+                if request[3] is None:
+                    writer.write(render_response(413))
+                    await writer.drain()
+                    break
+                try:
+                    response = await handler(*request)
+                except Exception as e:
+                    logger.error(f"Ошибка HTTP {request[0]} {request[1]}: {e}", exc_info=e)
+                    response = (500,)
+                writer.write(render_response(*response))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(connection, host, port)
@@ -0,0 +1,59 @@
+import os
+import sys
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bot import MESSAGE_HISTORY, MessageRing, User
+BASELINE = {
+    "start_date": "2025-03-01T09:15:42+03:00",
+    "active": True,
+    "state": "help_mode",
+    "best_streak": 12,
+    "message_ids": [101, 102, 103],
+    "hold_count": 2,
+    "hold_date": "2025-03-10",
+    "hold_time": "2025-03-10T14:05:00+03:00",
+    "pinned_message_id": 55,
+    "used_tips": [0, 3, 11]
+}
+def test_baseline_record_round_trips():
+    raw = User.from_json(BASELINE).to_json()
+    assert {key: raw[key] for key in BASELINE} == BASELINE
+    assert raw["message_times"] == []
+    assert raw["pinned_text"] is None
+def test_new_user_defaults_round_trip():
+    raw = dict(BASELINE, active=False, state="normal", best_streak=0, message_ids=[], hold_count=0, hold_date=None, hold_time=None, pinned_message_id=None, used_tips=[])
+    assert {key: value for key, value in User.from_json(raw).to_json().items() if key in raw} == raw
+def test_used_tips_become_bitmask():
+    user = User.from_json(BASELINE)
+    assert user.used_tips == 1 << 0 | 1 << 3 | 1 << 11
+    assert user.to_json()["used_tips"] == [0, 3, 11]
+def test_legacy_ids_keep_missing_send_times():
+    raw = dict(BASELINE, message_ids=[1, 2, 3, 4, 5], message_times=[1741000004, 1741000005])
+    user = User.from_json(raw)
+    ids, times = user.history.items()
+    assert ids.tolist() == [1, 2, 3, 4, 5]
+    assert times.tolist() == [0, 0, 0, 1741000004, 1741000005]
+    assert user.to_json()["message_ids"] == [1, 2, 3, 4, 5]
+    assert user.to_json()["message_times"] == [1741000004, 1741000005]
+def test_ring_wraps_past_history_limit():
+    ring = MessageRing()
+    for msg_id in range(MESSAGE_HISTORY + 100):
+        ring.append(msg_id, 1741000000 + msg_id)
+    ids, times = ring.to_lists()
+    assert len(ring) == MESSAGE_HISTORY
+    assert ids == list(range(100, MESSAGE_HISTORY + 100))
+    assert times == [1741000000 + msg_id for msg_id in ids]
+    assert MessageRing.from_lists(ids, times).to_lists() == (ids, times)
+def test_wrapped_ring_round_trips_through_json():
+    user = User.from_json(BASELINE)
+    for msg_id in range(1000, 1000 + MESSAGE_HISTORY + 37):
+        user.history.append(msg_id, 1741000000 + msg_id)
+    raw = user.to_json()
+    assert raw["message_ids"] == list(range(1037, 1000 + MESSAGE_HISTORY + 37))
+    assert User.from_json(raw).to_json() == raw
+def test_unknown_keys_survive():
+    raw = dict(BASELINE, note="привет")
+    assert User.from_json(raw).to_json()["note"] == "привет"
+def test_subsecond_timestamps_are_truncated():
+    raw = dict(BASELINE, start_date="2025-03-01T09:15:42.123456+03:00")
+    assert User.from_json(raw).to_json()["start_date"] == "2025-03-01T09:15:42+03:00"